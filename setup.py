@@ -10,7 +10,7 @@ SRC_DIR = os.path.join(ROOT_DIR, 'src')
 install_requires = [
     'gevent',
     'redis',
-    'psutil',
+    'psutil>=6.0',
 ]
 
 if sys.version_info[:2] < (3, 5):
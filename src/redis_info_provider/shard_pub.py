@@ -1,7 +1,7 @@
 import logging
 from enum import Enum
 from .redis_shard import RedisShard
-from typing import List, Set, Callable
+from typing import List, Set, Callable, Iterable
 
 
 logger = logging.getLogger(__name__)
@@ -112,9 +112,21 @@ class _ShardPublisher(object):
         :param shard: A RedisShard instance.
         """
         logger.info('Adding shard %s', shard.id)
-        self._shards[shard.id] = shard
-        for tgt in self._subs_new:
-            tgt(shard)
+        self._add(shard)
+
+    def add_shards(self, shards):
+        # type: (Iterable[RedisShard]) -> None
+
+        """
+        Notify the publisher multiple new shards have been added to the system. Equivalent to
+        calling add_shard() for each of them.
+        :param shards: An iterable of RedisShard instances.
+        """
+        shards = list(shards)
+        if shards:
+            logger.info('Adding shards %s', [shard.id for shard in shards])
+        for shard in shards:
+            self._add(shard)
 
     def del_shard(self, shard_id):
         # type: (str) -> None
@@ -125,6 +137,30 @@ class _ShardPublisher(object):
         :param shard_id: An identifier for a previously-added RedisShard.
         """
         logger.info('Deleting shard %s', shard_id)
+        self._remove(shard_id)
+
+    def del_shards(self, shard_ids):
+        # type: (Iterable[str]) -> None
+
+        """
+        Notify the publisher multiple shards have been removed from the system. Equivalent to
+        calling del_shard() for each of them.
+        :param shard_ids: An iterable of identifiers of previously-added RedisShards.
+        """
+        shard_ids = list(shard_ids)
+        if shard_ids:
+            logger.info('Deleting shards %s', shard_ids)
+        for shard_id in shard_ids:
+            self._remove(shard_id)
+
+    def _add(self, shard):
+        # type: (RedisShard) -> None
+        self._shards[shard.id] = shard
+        for tgt in self._subs_new:
+            tgt(shard)
+
+    def _remove(self, shard_id):
+        # type: (str) -> None
         shard = self._shards.pop(shard_id)
         for tgt in self._subs_del:
             tgt(shard)
@@ -0,0 +1,421 @@
+from unittest import TestCase, skipIf
+from mock import patch, Mock
+from collections import namedtuple
+import errno
+import io
+import socket
+import sys
+import time
+import gevent
+import psutil
+import six
+from redis_info_provider.local_watcher import LocalShardWatcher
+from redis_info_provider.redis_shard import RedisShard
+from redis_info_provider.shard_pub import _ShardPublisher
+
+
+Addr = namedtuple('Addr', ['ip', 'port'])
+Conn = namedtuple('Conn', ['laddr', 'status', 'pid'])
+
+
+class TestListenAddrs(TestCase):
+    def setUp(self):
+        # Exercise the portable (psutil-based) implementation regardless of the platform
+        patcher = patch('redis_info_provider.local_watcher.psutil.LINUX', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('redis_info_provider.local_watcher.psutil.net_connections')
+    def test_global_scan(self, net_connections):
+        net_connections.return_value = [
+            Conn(Addr('127.0.0.1', 1000), psutil.CONN_ESTABLISHED, 1),
+            Conn(Addr('127.0.0.1', 6379), psutil.CONN_LISTEN, 1),
+            Conn(Addr('127.0.0.1', 6380), psutil.CONN_LISTEN, 1),
+            Conn(Addr('0.0.0.0', 22), psutil.CONN_LISTEN, None),
+        ]
+        self.assertEqual({1: ('127.0.0.1', 6379)}, LocalShardWatcher._get_listen_addrs([1]))
+
+    @patch('redis_info_provider.local_watcher.psutil.Process')
+    @patch('redis_info_provider.local_watcher.psutil.net_connections',
+           side_effect=psutil.AccessDenied())
+    def test_access_denied_fallback(self, _, process):
+        conns = {
+            1: [Conn(Addr('127.0.0.1', 1000), psutil.CONN_ESTABLISHED, 1),
+                Conn(Addr('127.0.0.1', 6379), psutil.CONN_LISTEN, 1)],
+            2: [],
+        }
+
+        def make_process(pid):
+            if pid not in conns:
+                raise psutil.NoSuchProcess(pid)
+            return Mock(**{'net_connections.return_value': conns[pid]})
+        process.side_effect = make_process
+
+        self.assertEqual({1: ('127.0.0.1', 6379)}, LocalShardWatcher._get_listen_addrs([1, 2, 3]))
+
+
+# Sample /proc/net/tcp{,6} contents, as written by a little-endian kernel
+PROC_NET_TCP = (
+    u'  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n'
+    u'   0: 0100007F:18EB 00000000:0000 0A 00000000:00000000 00:00000000 00000000   999        0 1001 '
+    u'1 0000000000000000 100 0 0 10 0\n'
+    u'   1: 0100007F:18EB 0100007F:9C40 01 00000000:00000000 00:00000000 00000000   999        0 1002 '
+    u'1 0000000000000000 20 4 30 10 -1\n'
+    u'   2: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1003 '
+    u'1 0000000000000000 100 0 0 10 0\n'
+)
+PROC_NET_TCP6 = (
+    u'  sl  local_address                         remote_address                        st tx_queue rx_queue '
+    u'tr tm->when retrnsmt   uid  timeout inode\n'
+    u'   0: 00000000000000000000000001000000:18EC 00000000000000000000000000000000:0000 0A '
+    u'00000000:00000000 00:00000000 00000000   999        0 2001 1 0000000000000000 100 0 0 10 0\n'
+)
+
+# PID --> {fd: link target} for the processes in the sample /proc
+PROC_FDS = {
+    10: {'0': '/dev/null', '1': 'socket:[1002]', '2': 'socket:[1001]'},
+    11: {'0': 'socket:[2001]'},
+    12: {'0': 'socket:[1002]'},
+}
+
+
+@skipIf(sys.byteorder != 'little', 'sample /proc contents are little-endian')
+class TestListenMapLinux(TestCase):
+    def setUp(self):
+        self.files = {
+            '/proc/net/tcp': PROC_NET_TCP,
+            '/proc/net/tcp6': PROC_NET_TCP6,
+        }
+
+        def fake_open(path, *_):
+            if path not in self.files:
+                raise IOError(errno.ENOENT, 'No such file or directory', path)
+            return io.StringIO(self.files[path])
+
+        def fake_listdir(path):
+            pid = int(path.split('/')[2])
+            if pid not in PROC_FDS:
+                raise OSError(errno.EACCES, 'Permission denied', path)
+            return list(PROC_FDS[pid])
+
+        def fake_readlink(path):
+            _, _, pid, _, fd = path.split('/')
+            return PROC_FDS[int(pid)][fd]
+
+        for patcher in (patch('redis_info_provider.local_watcher.open', create=True, side_effect=fake_open),
+                        patch('redis_info_provider.local_watcher.os.listdir', side_effect=fake_listdir),
+                        patch('redis_info_provider.local_watcher.os.readlink', side_effect=fake_readlink)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_decode_ipv4(self):
+        self.assertEqual(('127.0.0.1', 6379),
+                         LocalShardWatcher._decode_proc_net_address('0100007F:18EB', socket.AF_INET))
+
+    def test_decode_ipv6(self):
+        self.assertEqual(('::1', 6380),
+                         LocalShardWatcher._decode_proc_net_address('00000000000000000000000001000000:18EC',
+                                                                    socket.AF_INET6))
+        self.assertEqual(('fe80::1', 80),
+                         LocalShardWatcher._decode_proc_net_address('000080FE000000000000000001000000:0050',
+                                                                    socket.AF_INET6))
+
+    def test_listen_map(self):
+        # PID 12 only has a non-listening socket; PID 13's fds can't be listed
+        self.assertEqual({10: ('127.0.0.1', 6379), 11: ('::1', 6380)},
+                         LocalShardWatcher._listen_map_linux([10, 11, 12, 13]))
+
+    def test_listen_map_without_ipv6(self):
+        del self.files['/proc/net/tcp6']
+        self.assertEqual({10: ('127.0.0.1', 6379)}, LocalShardWatcher._listen_map_linux([10, 11]))
+
+
+class TestProcessKeyLinux(TestCase):
+    def setUp(self):
+        patcher = patch('redis_info_provider.local_watcher.psutil.LINUX', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('redis_info_provider.local_watcher.open', create=True)
+    def test_start_time(self, fake_open):
+        # The process name may contain spaces and parentheses
+        fake_open.return_value = io.BytesIO(
+            b'42 (redis (x) 1) S 1 42 42 0 -1 4194560 1000 0 0 0 50 60 0 0 20 0 4 0 123456 '
+            b'60000000 2000 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 17 3 0 0 0 0 0\n')
+        self.assertEqual((42, 123456), LocalShardWatcher._get_process_key(42))
+        fake_open.assert_called_once_with('/proc/42/stat', 'rb')
+
+    @patch('redis_info_provider.local_watcher.open', create=True,
+           side_effect=IOError(errno.ENOENT, 'No such file or directory'))
+    def test_vanished_process(self, _):
+        self.assertIsNone(LocalShardWatcher._get_process_key(42))
+
+
+class TestRedisPidsLinux(TestCase):
+    def setUp(self):
+        # /proc/<pid>/comm contents; PIDs without an entry have vanished
+        self.comms = {
+            '1': b'systemd\n',
+            '3': b'redis-server\n',
+            '4': b'redis-sentinel\n',
+            '5': b'redis-server\n',
+            '6': b'redis-server',
+            '7': b'redis-server-x\n',
+            '8': b'redis-serve\n',
+        }
+
+        def fake_open(path, *_):
+            pid = path.split('/')[2]
+            if pid not in self.comms:
+                raise IOError(errno.ENOENT, 'No such file or directory', path)
+            return io.BytesIO(self.comms[pid])
+
+        for patcher in (patch('redis_info_provider.local_watcher.open', create=True, side_effect=fake_open),
+                        patch('redis_info_provider.local_watcher.os.listdir',
+                              return_value=['self', 'net', '1', '2', '3', '4', '5', '6', '7', '8', 'sys'])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_redis_pids(self):
+        # Only an exact name match counts, with or without the trailing newline
+        self.assertEqual([3, 5, 6], list(LocalShardWatcher._iter_redis_pids_linux()))
+
+
+class WatcherTestCase(TestCase):
+    def setUp(self):
+        self.watcher = LocalShardWatcher(update_frequency=1.0, full_rescan_interval=30.0)
+        # Keep the watcher's greenlet from ever running; the tests drive the watcher directly
+        self.watcher._greenlet.kill()
+        self.addCleanup(self.watcher._threadpool.kill)
+        super(WatcherTestCase, self).setUp()
+
+    def start_patch(self, patcher):
+        mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock
+
+
+class TestCurLiveShards(WatcherTestCase):
+    def setUp(self):
+        super(TestCurLiveShards, self).setUp()
+        self.pids = self.start_patch(patch('redis_info_provider.local_watcher.psutil.pids', return_value=[1, 2, 3]))
+        self.clock = self.start_patch(patch('redis_info_provider.local_watcher._monotonic', return_value=100.0))
+        self.next_retry_time = None
+
+        def get_live_shards():
+            self.watcher._next_retry_time = self.next_retry_time
+            return {}
+        self.get_live_shards = self.start_patch(
+            patch.object(self.watcher, '_get_live_shards', side_effect=get_live_shards))
+
+    def test_reuse_while_pids_unchanged(self):
+        shards = self.watcher._get_cur_live_shards()
+        self.clock.return_value += 1
+        self.assertIs(shards, self.watcher._get_cur_live_shards())
+        self.assertEqual(1, self.get_live_shards.call_count)
+
+    def test_rescan_on_pids_changed(self):
+        self.watcher._get_cur_live_shards()
+        self.pids.return_value = [1, 2, 4]
+        self.watcher._get_cur_live_shards()
+        self.assertEqual(2, self.get_live_shards.call_count)
+        # The new PID set is remembered
+        self.watcher._get_cur_live_shards()
+        self.assertEqual(2, self.get_live_shards.call_count)
+
+    def test_rescan_on_interval(self):
+        self.watcher._get_cur_live_shards()
+        self.clock.return_value += 29
+        self.watcher._get_cur_live_shards()
+        self.assertEqual(1, self.get_live_shards.call_count)
+        self.clock.return_value += 1
+        self.watcher._get_cur_live_shards()
+        self.assertEqual(2, self.get_live_shards.call_count)
+
+    def test_rescan_when_retry_due(self):
+        self.next_retry_time = 101.0
+        self.watcher._get_cur_live_shards()
+        self.clock.return_value += 0.25
+        self.watcher._get_cur_live_shards()
+        self.assertEqual(1, self.get_live_shards.call_count)
+        self.next_retry_time = None
+        self.clock.return_value += 0.75
+        self.watcher._get_cur_live_shards()
+        self.assertEqual(2, self.get_live_shards.call_count)
+        self.clock.return_value += 1
+        self.watcher._get_cur_live_shards()
+        self.assertEqual(2, self.get_live_shards.call_count)
+
+
+class TestLiveShards(WatcherTestCase):
+    def setUp(self):
+        super(TestLiveShards, self).setUp()
+        self.create_times = {1: 10.0, 2: 20.0}
+        self.listen_addrs = {1: ('127.0.0.1', 6379), 2: ('127.0.0.1', 6380)}
+        self.start_patch(patch.object(self.watcher, '_get_running_redis_pids',
+                                      side_effect=lambda: list(self.create_times)))
+        self.start_patch(patch.object(self.watcher, '_get_process_key',
+                                      side_effect=lambda pid: (pid, self.create_times[pid])))
+        self.get_listen_addrs = self.start_patch(
+            patch.object(self.watcher, '_get_listen_addrs',
+                         side_effect=lambda pids: {pid: self.listen_addrs[pid] for pid in pids
+                                                   if pid in self.listen_addrs}))
+        self.clock = self.start_patch(patch('redis_info_provider.local_watcher._monotonic', return_value=100.0))
+
+    def probed_pids(self):
+        return sorted(self.get_listen_addrs.call_args[0][0])
+
+    def test_known_processes_not_probed(self):
+        shards = self.watcher._get_live_shards()
+        self.assertEqual(['1', '2'], sorted(shards))
+        self.assertEqual([1, 2], self.probed_pids())
+
+        self.get_listen_addrs.reset_mock()
+        new_shards = self.watcher._get_live_shards()
+        self.assertFalse(self.get_listen_addrs.called)
+        self.assertIs(shards['1'], new_shards['1'])
+        self.assertIs(shards['2'], new_shards['2'])
+        self.assertIsNone(self.watcher._next_retry_time)
+
+    def test_changed_create_time(self):
+        shards = self.watcher._get_live_shards()
+        self.create_times[2] = 30.0
+        new_shards = self.watcher._get_live_shards()
+        self.assertEqual([2], self.probed_pids())
+        self.assertIs(shards['1'], new_shards['1'])
+        self.assertIsNot(shards['2'], new_shards['2'])
+
+    def test_vanished_process_dropped(self):
+        self.watcher._get_live_shards()
+        del self.create_times[2]
+        self.assertEqual(['1'], list(self.watcher._get_live_shards()))
+        self.assertEqual([(1, 10.0)], list(self.watcher._shard_cache))
+
+    def test_unprobed_process_retried(self):
+        del self.listen_addrs[2]
+        self.assertEqual(['1'], list(self.watcher._get_live_shards()))
+        # Retried on the next tick
+        self.assertEqual(101.0, self.watcher._next_retry_time)
+
+        self.clock.return_value += 1
+        self.listen_addrs[2] = ('127.0.0.1', 6380)
+        self.assertEqual(['1', '2'], sorted(self.watcher._get_live_shards()))
+        self.assertEqual([2], self.probed_pids())
+        self.assertIsNone(self.watcher._next_retry_time)
+
+    def test_unprobed_process_backoff(self):
+        del self.listen_addrs[2]
+        self.watcher._get_live_shards()
+        retry_times = []
+        while self.clock.return_value < 200:
+            self.clock.return_value += 1
+            self.get_listen_addrs.reset_mock()
+            self.watcher._get_live_shards()
+            if self.get_listen_addrs.called:
+                self.assertEqual([2], self.probed_pids())
+                retry_times.append(self.clock.return_value)
+        # Retry interval doubles on each failure, up to the full re-scan interval
+        self.assertEqual([101, 103, 107, 115, 131, 161, 191], retry_times)
+
+    def test_failed_scan_retried(self):
+        del self.listen_addrs[2]
+        self.watcher._get_live_shards()
+        self.clock.return_value += 1
+        self.get_listen_addrs.side_effect = ValueError
+        self.assertRaises(ValueError, self.watcher._get_live_shards)
+        self.assertEqual(101.0, self.watcher._next_retry_time)
+
+
+class TestUpdateShards(WatcherTestCase):
+    def setUp(self):
+        super(TestUpdateShards, self).setUp()
+        self.publisher = _ShardPublisher()
+        self.start_patch(patch('redis_info_provider.local_watcher.ShardPublisher', self.publisher))
+        self.shards = {str(i): RedisShard(i, None) for i in range(2)}
+        self.get_cur_live_shards = self.start_patch(
+            patch.object(self.watcher, '_get_cur_live_shards', side_effect=lambda: self.shards))
+        self.added = []
+        self.publisher.subscribe_shard_event(self.publisher.ShardEvent.ADDED, self.added.append)
+
+    def test_publish(self):
+        self.watcher._update_shards()
+        six.assertCountEqual(self, self.shards.values(), self.publisher.get_live_shards())
+
+        del self.shards['0']
+        self.shards['2'] = RedisShard(2, None)
+        self.watcher._update_shards()
+        six.assertCountEqual(self, self.shards.values(), self.publisher.get_live_shards())
+
+    def test_unchanged(self):
+        self.watcher._update_shards()
+        del self.added[:]
+        self.watcher._update_shards()
+        self.assertEqual([], self.added)
+
+    def test_replaced_shard(self):
+        # Same identifier, different RedisShard (e.g. the PID was reused by a new redis-server)
+        self.watcher._update_shards()
+        removed = []
+        self.publisher.subscribe_shard_event(self.publisher.ShardEvent.REMOVED, removed.append)
+        old_shard = self.shards['1']
+        self.shards['1'] = RedisShard(1, None)
+        self.watcher._update_shards()
+        self.assertEqual([old_shard], removed)
+        self.assertIs(self.shards['1'], self.publisher.get_shard('1'))
+
+    def test_unchanged_after_replace(self):
+        self.watcher._update_shards()
+        self.shards['1'] = RedisShard(1, None)
+        self.watcher._update_shards()
+        del self.added[:]
+        with patch('redis_info_provider.local_watcher.logger') as logger:
+            self.watcher._update_shards()
+        self.assertEqual([], self.added)
+        self.assertFalse(logger.info.called)
+
+    def test_scan_error(self):
+        # Raised in the watcher's greenlet, without gevent also reporting it from the worker thread
+        self.get_cur_live_shards.side_effect = RuntimeError
+        with patch.object(type(gevent.get_hub()), 'handle_error') as handle_error:
+            self.assertRaises(RuntimeError, self.watcher._update_shards)
+        self.assertFalse(handle_error.called)
+
+    def test_external_publisher_change(self):
+        self.watcher._update_shards()
+        self.publisher.clear_shards()
+        self.watcher._update_shards()
+        six.assertCountEqual(self, self.shards.values(), self.publisher.get_live_shards())
+
+
+class TestGreenletMain(TestCase):
+    def setUp(self):
+        patcher = patch('redis_info_provider.local_watcher.ShardPublisher', _ShardPublisher())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('redis_info_provider.local_watcher.logger')
+        self.logger = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(LocalShardWatcher, '_update_shards')
+    def test_stop_wakes_watcher(self, update_shards):
+        watcher = LocalShardWatcher(update_frequency=60.0)
+        gevent.sleep(0.05)
+        self.assertEqual(1, update_shards.call_count)
+
+        start = time.time()
+        watcher.stop()
+        self.assertLess(time.time() - start, 1.0)
+        self.assertTrue(watcher._greenlet.dead)
+
+    @patch.object(LocalShardWatcher, 'ERROR_BACKOFF', 0.05)
+    @patch.object(LocalShardWatcher, '_update_shards', side_effect=[RuntimeError, RuntimeError, None])
+    def test_error_backoff(self, update_shards):
+        with LocalShardWatcher(update_frequency=60.0) as watcher:
+            gevent.sleep(0.02)
+            # Failed once, waiting for the back-off interval to pass
+            self.assertEqual(1, update_shards.call_count)
+            gevent.sleep(0.2)
+            # Retried until the update succeeded, then waits for the next tick as usual
+            self.assertEqual(3, update_shards.call_count)
+            self.assertEqual(2, self.logger.exception.call_count)
+            self.assertFalse(watcher._greenlet.dead)
@@ -31,6 +31,19 @@ class TestShardPublisher(TestCase):
         six.assertCountEqual(self, shards[-1:], ShardPublisher.get_live_shards())
         six.assertCountEqual(self, [s.id for s in shards[-1:]], ShardPublisher.get_live_shard_ids())
 
+    def test_bulk_shard_tracking(self):
+        shards = [self.make_dummy_shard(i) for i in range(3)]
+
+        ShardPublisher.add_shards(shards)
+
+        six.assertCountEqual(self, shards, ShardPublisher.get_live_shards())
+        six.assertCountEqual(self, [s.id for s in shards], ShardPublisher.get_live_shard_ids())
+
+        ShardPublisher.del_shards(s.id for s in shards[:2])
+
+        six.assertCountEqual(self, shards[-1:], ShardPublisher.get_live_shards())
+        six.assertCountEqual(self, [s.id for s in shards[-1:]], ShardPublisher.get_live_shard_ids())
+
     def test_get_shard(self):
         s = self.make_dummy_shard(5)
         ShardPublisher.add_shard(s)
@@ -51,6 +64,20 @@ class TestShardPublisher(TestCase):
         ShardPublisher.del_shard(s.id)
         self.assertEqual(1, notify_del.times_notified)
 
+    def test_bulk_shard_events(self):
+        shards = [self.make_dummy_shard(i) for i in range(3)]
+
+        notify_add = NotificationTracker()
+        notify_del = NotificationTracker()
+        ShardPublisher.subscribe_shard_event(ShardPublisher.ShardEvent.ADDED, notify_add.notify)
+        ShardPublisher.subscribe_shard_event(ShardPublisher.ShardEvent.REMOVED, notify_del.notify)
+
+        ShardPublisher.add_shards(shards)
+        self.assertEqual(len(shards), notify_add.times_notified)
+
+        ShardPublisher.del_shards(s.id for s in shards)
+        self.assertEqual(len(shards), notify_del.times_notified)
+
     def test_unsub_shard_event(self):
         s = self.make_dummy_shard(5)
 